@@ -0,0 +1,212 @@
+import torch
+
+from topotein.models.graph_encoders.layers.ETNN import (
+    ETNNLayer,
+    cast_and_gather,
+    prepare_topology,
+    scaled_gather,
+)
+
+
+def _sparse(indices, values, size):
+    return torch.sparse_coo_tensor(
+        torch.tensor(indices), torch.tensor(values), size
+    ).coalesce()
+
+
+def _expected_gather(N, A, H):
+    """For every nonzero (i, j) of A: N[c, i] * H[c] for the first cell c
+    containing node i, or zero if no cell contains it."""
+    dense = N.to_dense()
+    rows = []
+    for i in A._indices()[0].tolist():
+        cells = dense[:, i].nonzero().flatten()
+        if cells.numel() == 0:
+            rows.append(torch.zeros(H.size(1)))
+        else:
+            rows.append(dense[cells[0], i] * H[cells[0]])
+    return torch.stack(rows)
+
+
+def _topology():
+    # SSE 0 = {1, 3}, SSE 1 = {0, 2, 3}: coalescing N2_0.T would reorder these
+    # nonzeros by node, pairing nodes with the wrong SSE. Node 4 is in no SSE.
+    N2_0 = _sparse(
+        [[0, 0, 1, 1, 1], [1, 3, 0, 2, 3]], [1.0, 2.0, 3.0, 4.0, 5.0], (2, 5)
+    )
+    N0_0_via_2 = _sparse(
+        [[0, 1, 2, 3, 3, 4], [2, 3, 0, 1, 2, 4]], [1.0] * 6, (5, 5)
+    )
+    # edge 0 = (2, 1), edge 1 = (0, 1); nodes 3 and 4 have no edge
+    N1_0 = _sparse([[0, 0, 1, 1], [1, 2, 0, 1]], [-1.0, 1.0, 2.0, -2.0], (2, 5))
+    N0_0_via_1 = _sparse(
+        [[0, 1, 1, 2, 3, 4], [1, 0, 2, 1, 4, 3]], [1.0] * 6, (5, 5)
+    )
+    return N0_0_via_1, N0_0_via_2, N2_0, N1_0
+
+
+def _random_inputs(num_nodes=60, num_sse=6, emb_dim=16, seed=0):
+    """Layer inputs for a chain of nodes with a few random extra edges, where
+    most nodes belong to one of `num_sse` SSEs."""
+    g = torch.Generator().manual_seed(seed)
+    chain = torch.arange(num_nodes - 1)
+    extra = torch.randint(0, num_nodes, (2, num_nodes), generator=g)
+    edges = torch.cat(
+        [torch.stack([chain, chain + 1]), extra[:, extra[0] != extra[1]]], dim=1
+    )
+    edges = torch.unique(edges.sort(dim=0).values, dim=1)
+    num_edges = edges.size(1)
+    N1_0 = _sparse(
+        torch.stack([torch.arange(num_edges).repeat(2), edges.flatten()]).tolist(),
+        [1.0] * (2 * num_edges),
+        (num_edges, num_nodes),
+    )
+    N0_0_via_1 = _sparse(
+        torch.cat([edges, edges.flip(0)], dim=1).tolist(),
+        [1.0] * (2 * num_edges),
+        (num_nodes, num_nodes),
+    )
+    nodes = torch.arange(num_nodes)[torch.rand(num_nodes, generator=g) < 0.8]
+    sse = torch.randint(0, num_sse, (nodes.numel(),), generator=g)
+    N2_0 = _sparse(
+        [sse.tolist(), nodes.tolist()], [1.0] * nodes.numel(), (num_sse, num_nodes)
+    )
+    N0_0_via_2 = torch.sparse.mm(N2_0.T, N2_0).coalesce()
+    X = torch.randn(num_nodes, 3, generator=g) * 5
+    H0 = torch.randn(num_nodes, emb_dim, generator=g)
+    H1 = torch.randn(num_edges, 2, generator=g)
+    H2 = torch.randn(num_sse, 4, generator=g)
+    return X, H0, H1, H2, N0_0_via_1, N0_0_via_2, N2_0, N1_0
+
+
+def test_cast_and_gather_pairs_nodes_with_their_first_cell():
+    """Tests each neighbourhood nonzero gathers the attributes of the first
+    cell containing its source node, scaled by the incidence value."""
+    torch.manual_seed(0)
+    N0_0_via_1, N0_0_via_2, N2_0, N1_0 = _topology()
+    H2, H1 = torch.randn(2, 4), torch.randn(2, 3)
+
+    for N, A, H in ((N2_0, N0_0_via_2, H2), (N1_0, N0_0_via_1, H1)):
+        expected = _expected_gather(N, A, H)
+        # `N.T` without coalescing keeps the nonzero order of N
+        torch.testing.assert_close(cast_and_gather(N.T, H, N, A), expected)
+
+
+def test_prepare_topology_gather_matches_cast_and_gather():
+    """Tests the cached gather indices reproduce the same attribute pairing."""
+    torch.manual_seed(0)
+    N0_0_via_1, N0_0_via_2, N2_0, N1_0 = _topology()
+    H2, H1 = torch.randn(2, 4), torch.randn(2, 3)
+    topology = prepare_topology(N0_0_via_1, N0_0_via_2, N2_0, N1_0)
+
+    torch.testing.assert_close(
+        scaled_gather(H2, *topology["gather_2"]),
+        _expected_gather(N2_0, N0_0_via_2, H2),
+    )
+    torch.testing.assert_close(
+        scaled_gather(H1, *topology["gather_1"]),
+        _expected_gather(N1_0, N0_0_via_1, H1),
+    )
+
+
+def test_training_after_inference_mode():
+    """Tests a topology first seen under inference mode can be trained on."""
+    for position_update in (False, True):
+        torch.manual_seed(0)
+        layer = ETNNLayer(16, position_update=position_update)
+        inputs = _random_inputs()
+        with torch.inference_mode():
+            layer(*inputs)
+        H0, X = layer(*inputs)
+        (H0.sum() + X.sum()).backward()
+
+        assert all(
+            p.grad is not None and torch.isfinite(p.grad).all()
+            for p in layer.parameters()
+        )
+
+
+def test_fuse_for_inference_keeps_eval_output():
+    """Tests folding batch norms and dropping dropouts leaves the eval output
+    unchanged."""
+    torch.manual_seed(0)
+    layer = ETNNLayer(16, norm="batch", position_update=True)
+    inputs = _random_inputs()
+    with torch.no_grad():
+        # non-trivial running statistics and affine parameters
+        for _ in range(3):
+            layer(*inputs)
+        for module in layer.modules():
+            if isinstance(module, torch.nn.BatchNorm1d):
+                module.weight.uniform_(0.5, 2.0)
+                module.bias.uniform_(-1.0, 1.0)
+    layer.eval()
+    mlps = ["phi_sse", "phi_edge", "phi_x", "phi_update"]
+    num_linear = {
+        name: sum(isinstance(m, torch.nn.Linear) for m in getattr(layer, name))
+        for name in mlps
+    }
+
+    with torch.no_grad():
+        H0, X = layer(*inputs)
+        layer.fuse_for_inference()
+        H0_fused, X_fused = layer(*inputs)
+
+    torch.testing.assert_close(H0_fused, H0)
+    torch.testing.assert_close(X_fused, X)
+    for name in mlps:
+        modules = list(getattr(layer, name))
+        assert not any(
+            isinstance(m, (torch.nn.Dropout, torch.nn.BatchNorm1d)) for m in modules
+        )
+        assert sum(isinstance(m, torch.nn.Linear) for m in modules) == num_linear[name]
+
+
+def test_stack_without_grad_matches_grad_path():
+    """Tests a stack of layers sharing one topology, whose gathers then write
+    into shared workspace buffers, matches the autograd path and is stable
+    across runs."""
+    torch.manual_seed(0)
+    layers = [ETNNLayer(16, position_update=True).eval() for _ in range(3)]
+    X, H0, *topology = _random_inputs()
+    key = topology[1]
+
+    def run():
+        H, pos = H0, X
+        for layer in layers:
+            H, pos = layer(pos, H, *topology, topology_key=key)
+        return H, pos
+
+    H_grad, X_grad = run()
+    with torch.no_grad():
+        H_first, X_first = run()
+        H_second, X_second = run()
+
+    torch.testing.assert_close(H_first, H_grad)
+    torch.testing.assert_close(X_first, X_grad)
+    assert torch.equal(H_second, H_first) and torch.equal(X_second, X_first)
+
+
+def test_sparsify_prunes_to_two_of_four():
+    """Tests every pruned group of four weights keeps at most two, while the
+    distance and attribute columns of the first message Linears stay dense."""
+    torch.manual_seed(0)
+    emb_dim = 16
+    layer = ETNNLayer(emb_dim, position_update=True).eval()
+    dense = {name: p.clone() for name, p in layer.named_parameters()}
+    layer.sparsify()
+
+    for name, weight in layer.named_parameters():
+        if not name.endswith("weight") or weight.dim() != 2:
+            continue
+        if name in ("phi_sse.0.weight", "phi_edge.0.weight"):
+            head = 2 * emb_dim
+        else:
+            head = weight.size(1) - weight.size(1) % 4
+        groups = weight[:, :head].reshape(weight.size(0), -1, 4)
+        assert ((groups != 0).sum(dim=-1) <= 2).all(), name
+        assert torch.equal(weight[:, head:], dense[name][:, head:]), name
+
+    with torch.no_grad():
+        H0, X = layer(*_random_inputs(emb_dim=emb_dim))
+    assert torch.isfinite(H0).all() and torch.isfinite(X).all()
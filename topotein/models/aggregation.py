@@ -1,7 +1,30 @@
+import torch
 from topomodelx import Aggregation
 from topomodelx.utils.scatter import scatter
 
 
+def row_incidence_csr(neighborhood_matrix: torch.Tensor) -> torch.Tensor:
+    """
+    Builds the CSR matrix R of shape [neighborhood_matrix.size(0), nnz] with
+    R[i, e] = 1 iff the e-th nonzero of the (coalesced) neighborhood matrix lies
+    in row i, so that `R @ x` sums per-nonzero messages x by row.
+
+    The matrix only depends on the sparsity pattern, so it can be built once per
+    topology and reused by every `IntraNeighborhoodAggregator` call.
+    """
+    rows = neighborhood_matrix._indices()[0]
+    nnz = rows.size(0)
+    crow_indices = torch.zeros(neighborhood_matrix.size(0) + 1, dtype=torch.long, device=rows.device)
+    # coalesced indices are sorted by row, so the nonzeros of each row are contiguous
+    crow_indices[1:] = torch.bincount(rows, minlength=neighborhood_matrix.size(0)).cumsum(0)
+    return torch.sparse_csr_tensor(
+        crow_indices,
+        torch.arange(nnz, device=rows.device),
+        torch.ones(nnz, dtype=neighborhood_matrix.dtype, device=rows.device),
+        size=(neighborhood_matrix.size(0), nnz),
+    )
+
+
 class Aggregator(Aggregation):
     def __init__(self, aggr_func="sum"):
         super().__init__(aggr_func=aggr_func, update_func=None)
@@ -16,7 +39,20 @@ class InterNeighborhoodAggregator(Aggregator):
         return f"InterNeighborhoodAggregator(aggr_func={self.aggr_func})"
 
 class IntraNeighborhoodAggregator(Aggregator):
-    def forward(self, neighborhood_matrix, x):
-        return scatter(self.aggr_func)(x, neighborhood_matrix.indices()[0], dim=0, dim_size=neighborhood_matrix.size(0))
+    def forward(self, neighborhood_matrix, x, row_incidence=None):
+        # `row_incidence` is the optional output of `row_incidence_csr(neighborhood_matrix)`,
+        # with which the aggregation runs as a single SpMM instead of a scatter
+        if row_incidence is not None and self.aggr_func in ("sum", "add", "mean"):
+            if row_incidence.dtype != x.dtype:
+                row_incidence = row_incidence.to(x.dtype)
+            reduce = "mean" if self.aggr_func == "mean" else "sum"
+            if x.device.type == "cpu":
+                # `reduce` is only implemented for CSR on CPU, where it also covers bfloat16
+                return torch.sparse.mm(row_incidence, x, reduce=reduce)
+            out = torch.sparse.mm(row_incidence, x)
+            if reduce == "mean":
+                out = out / row_incidence.crow_indices().diff().clamp(min=1).unsqueeze(1)
+            return out
+        return scatter(self.aggr_func)(x, neighborhood_matrix._indices()[0], dim=0, dim_size=neighborhood_matrix.size(0))
     def __repr__(self):
         return f"IntraNeighborhoodAggregator(aggr_func={self.aggr_func})"
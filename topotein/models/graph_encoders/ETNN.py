@@ -79,7 +79,7 @@ class ETNNModel(torch.nn.Module):
 
 
         for layer in self.layers:
-            H0, X = layer(X, H0, H1, H2, N0_0_via_1, N0_0_via_2, N2_0, N1_0)
+            H0, X = layer(X, H0, H1, H2, N0_0_via_1, N0_0_via_2, N2_0, N1_0, topology_key=batch)
         return {
             "node_embedding": H0,
             # "edge_embedding": torch.cat([H1, H1], dim=-1),
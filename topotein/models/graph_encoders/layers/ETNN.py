@@ -1,20 +1,230 @@
+import functools
+from contextlib import nullcontext
+from typing import Optional, Tuple
+
 import torch
 from topomodelx import MessagePassing, Aggregation
 from torch.nn import Sequential, Linear, Dropout
-from torch_scatter import scatter_min, scatter_add, scatter_mean
+from torch.utils.weak import WeakIdKeyDictionary
+from torch_scatter import scatter_add, scatter_mean, segment_csr
 
 from proteinworkshop.models.utils import get_activations
-from topotein.models.aggregation import InterNeighborhoodAggregator, IntraNeighborhoodAggregator
+from topotein.models.aggregation import InterNeighborhoodAggregator, IntraNeighborhoodAggregator, row_incidence_csr
+from topotein.models.graph_encoders.layers.kernels import TRITON_AVAILABLE, triton_scaled_gather
+
+
+# Derived topology tensors (e.g. link mappings), keyed by the
+# object identifying a batch topology. Entries are dropped together with the key.
+_TOPOLOGY_CACHE = WeakIdKeyDictionary()
+
+# Side stream per CUDA device for `parallel_branches`, shared by all layers. Kept out of
+# the layers since streams can't be pickled or deep-copied.
+_SIDE_STREAMS = {}
+
+
+def sparse_link_mapping(
+        S1: torch.sparse_coo_tensor,
+        S2: torch.sparse_coo_tensor
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """
+    Builds the mapping used by `cast_dense_by_sparse_link`: for each nonzero in S2,
+    the index of the first nonzero in S1 sharing its linking key. Both S1 and S2
+    must be coalesced.
+
+    The mapping only depends on the sparsity pattern of S1 and S2, so it can be
+    computed once per topology and reused across layers.
+
+    Args:
+        S1 (torch.sparse_coo_tensor): Sparse tensor whose second row of indices holds the keys.
+        S2 (torch.sparse_coo_tensor): Sparse tensor whose first row of indices holds the keys.
+
+    Returns:
+        Tuple[torch.Tensor, Optional[torch.Tensor]]: `mapped_idx` of shape [nnz_S2] (-1 where
+            the key is not found in S1) and the boolean `valid` mask, which is None when
+            every key of S2 is found in S1.
+    """
+    assert S1.is_coalesced() and S2.is_coalesced(), "S1 and S2 must be coalesced"
+    # --- Extract linking keys ---
+    # For S1, we use its second row of indices as keys (values in 0 .. S1.size(1)-1).
+    S1_idx = S1._indices()           # shape: [2, nnz_S1]
+    keys_S1 = S1_idx[1]              # shape: [nnz_S1]
+
+    # For S2, we use its first row of indices as keys.
+    S2_idx = S2._indices()           # shape: [2, nnz_S2]
+    keys_S2 = S2_idx[0]              # shape: [nnz_S2]
+
+    # --- Build mapping from keys to first occurrence index in S1 ---
+    # Coalescing sorts S1 by (row, col), so its keys are not globally sorted. A stable
+    # sort keeps equal keys in S1 order, hence the leftmost match is the first occurrence.
+    sorted_keys, sort_idx = keys_S1.sort(stable=True)  # shape: [nnz_S1]
+    if sorted_keys.numel() == 0:
+        return torch.full_like(keys_S2, -1), torch.zeros_like(keys_S2, dtype=torch.bool)
+    # For each nonzero in S2 (each key in keys_S2), find the leftmost matching S1 key.
+    pos = torch.searchsorted(sorted_keys, keys_S2).clamp_(max=sorted_keys.numel() - 1)  # shape: [nnz_S2]
+    # Determine positions where a valid mapping exists (the key occurs in S1).
+    valid = sorted_keys[pos] == keys_S2  # Boolean tensor of shape [nnz_S2]
+    # Map back to S1 positions, marking keys that did not occur in S1 as -1.
+    mapped_idx = torch.where(valid, sort_idx[pos], -1)  # shape: [nnz_S2]
+    if valid.all():
+        # Lets callers skip masking altogether.
+        valid = None
+    return mapped_idx, valid
+
+
+def sparse_link_gather_index(
+        cols: torch.Tensor,
+        vals: torch.Tensor,
+        mapping: Tuple[torch.Tensor, Optional[torch.Tensor]]
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Resolves a link mapping into the row index and scale consumed by `scaled_gather`,
+    such that `scaled_gather(H, index, scale)` equals `cast_and_gather(M, H, S1, S2)`
+    for `cols, vals = M._indices()[1], M._values()`.
+
+    :param cols: Column index of every nonzero of M, in the nonzero order of S1.
+    :param vals: Value of every nonzero of M, in the nonzero order of S1.
+    :param mapping: Output of `sparse_link_mapping(S1, S2)`.
+    :return: Row index into H and scale of every nonzero of S2 (0 where the key is not
+             found in S1).
+    """
+    mapped_idx, valid = mapping
+    safe_idx = mapped_idx.clamp(min=0)
+    if cols.numel() == 0:
+        # S1 is empty, so every row is masked out
+        return safe_idx, torch.zeros(safe_idx.size(0), dtype=vals.dtype, device=vals.device)
+    index = cols.index_select(0, safe_idx)  # shape: [nnz_S2]
+    scale = vals.index_select(0, safe_idx)  # shape: [nnz_S2]
+    if valid is not None:
+        scale = scale * valid.to(scale.dtype)
+    return index, scale
+
+
+def sparse_link_cast_index(
+        mapping: Tuple[torch.Tensor, Optional[torch.Tensor]],
+        dtype: torch.dtype = torch.float
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """
+    Resolves a link mapping into the row index and mask consumed by `scaled_gather`,
+    such that `scaled_gather(x, index, mask)` equals `cast_dense_by_sparse_link(x, S1, S2)`.
+    The mask is None when every key is found.
+    """
+    mapped_idx, valid = mapping
+    return mapped_idx.clamp(min=0), None if valid is None else valid.to(dtype)
+
+
+def prepare_topology(
+        N0_0_via_1: torch.sparse_coo_tensor,
+        N0_0_via_2: torch.sparse_coo_tensor,
+        N2_0: torch.sparse_coo_tensor,
+        N1_0: torch.sparse_coo_tensor,
+        topology_key: Optional[object] = None
+) -> dict:
+    """
+    Returns the tensors derived from a batch topology that every ETNN layer needs,
+    computing them only on the first call for a given `topology_key` (and once more
+    if that call ran under `torch.inference_mode` and a later one does not).
+
+    :param N0_0_via_1: Node-to-node adjacency via edges.
+    :param N0_0_via_2: Node-to-node adjacency via SSEs.
+    :param N2_0: SSE-to-node incidence.
+    :param N1_0: Edge-to-node incidence.
+    :param topology_key: Object identifying the topology (e.g. the batch). The
+                         cached entry lives as long as this object does.
+                         Defaults to `N0_0_via_2`.
+    :return: Dictionary with the link mappings `link_2` (N2_0 -> N0_0_via_2) and
+             `link_1` (N1_0 -> N0_0_via_1), the `scaled_gather` arguments resolved from
+             them (`gather_*` for `cast_and_gather(N*_0.T, ...)`, `cast_*` for
+             `cast_dense_by_sparse_link(..., N*_0, ...)`), the CSR row incidences `rows_2` and
+             `rows_1` of N0_0_via_2 and N0_0_via_1 used for intra-neighborhood aggregation,
+             and the concatenated node indices `src` and `dst` of both adjacencies.
+    """
+    if topology_key is None:
+        topology_key = N0_0_via_2
+    topology = _TOPOLOGY_CACHE.get(topology_key)
+    # tensors built under inference mode can't be saved for backward, so an entry first
+    # built there is rebuilt when the same topology is used outside of it
+    if topology is None or (topology["src"].is_inference() and not torch.is_inference_mode_enabled()):
+        link_2 = sparse_link_mapping(N2_0, N0_0_via_2)
+        link_1 = sparse_link_mapping(N1_0, N0_0_via_1)
+        topology = {
+            "link_2": link_2,
+            "link_1": link_1,
+            # the columns of N*_0.T are the rows of N*_0, in the same nonzero order
+            "gather_2": sparse_link_gather_index(N2_0._indices()[0], N2_0._values(), link_2),
+            "gather_1": sparse_link_gather_index(N1_0._indices()[0], N1_0._values(), link_1),
+            "cast_2": sparse_link_cast_index(link_2, N2_0.dtype),
+            "cast_1": sparse_link_cast_index(link_1, N1_0.dtype),
+            "rows_2": row_incidence_csr(N0_0_via_2),
+            "rows_1": row_incidence_csr(N0_0_via_1),
+            # source/target node of every nonzero of N0_0_via_2 followed by N0_0_via_1.
+            # Coalesced order sorts `src`, so consecutive gathers read the same or adjacent
+            # rows of H0, and each row is one contiguous read; features are thus kept
+            # row-major rather than in a tiled layout.
+            "src": torch.cat([N0_0_via_2._indices()[0], N0_0_via_1._indices()[0]]),
+            "dst": torch.cat([N0_0_via_2._indices()[1], N0_0_via_1._indices()[1]]),
+        }
+        _TOPOLOGY_CACHE[topology_key] = topology
+    return topology
+
+
+def workspace_buffer(topology: dict, name: str, shape: Tuple[int, ...], like: torch.Tensor) -> Optional[torch.Tensor]:
+    """
+    Returns an uninitialised buffer that is reused by every layer sharing `topology`,
+    so that stacked layers do not reallocate their large per-edge intermediates.
+
+    :param topology: Dictionary returned by `prepare_topology`.
+    :param name: Name of the buffer within the topology's workspace.
+    :param shape: Required shape of the buffer.
+    :param like: Tensor whose dtype and device the buffer should have.
+    :return: The buffer, or None while autograd is recording, since reusing storage
+             would overwrite tensors saved for the backward pass.
+    """
+    if torch.is_grad_enabled():
+        return None
+    workspace = topology.setdefault("workspace", {})
+    buf = workspace.get(name)
+    if (buf is None or buf.shape != shape or buf.dtype != like.dtype or buf.device != like.device
+            or buf.is_inference() != torch.is_inference_mode_enabled()):
+        buf = workspace[name] = torch.empty(shape, dtype=like.dtype, device=like.device)
+    return buf
+
+
+def scaled_gather(
+        H: torch.Tensor,
+        index: torch.Tensor,
+        scale: Optional[torch.Tensor] = None,
+        out: Optional[torch.Tensor] = None
+) -> torch.Tensor:
+    """
+    Gathers the rows `index` of H and multiplies each by its entry of `scale`.
+
+    :param H: Dense tensor of shape [n, d].
+    :param index: Row index of shape [m].
+    :param scale: Optional per-row scale of shape [m].
+    :param out: Optional [m, d] tensor to write the result into.
+    :return: Dense tensor of shape [m, d].
+    """
+    if H.size(0) == 0:
+        # nothing to gather from, every row is masked out
+        return out.zero_() if out is not None else H.new_zeros(index.size(0), H.size(-1))
+    if scale is not None and H.is_cuda and TRITON_AVAILABLE:
+        # one fused kernel instead of index_select followed by the scaling
+        return triton_scaled_gather(H, index, scale, out=out)
+    rows = torch.index_select(H, 0, index, out=out)
+    if scale is not None:
+        rows.mul_(scale.unsqueeze(1).to(rows.dtype))
+    return rows
 
 
 def cast_dense_by_sparse_link(
         x: torch.Tensor,
         S1: torch.sparse_coo_tensor,
-        S2: torch.sparse_coo_tensor
+        S2: torch.sparse_coo_tensor,
+        mapping: Optional[Tuple[torch.Tensor, Optional[torch.Tensor]]] = None
 ) -> torch.Tensor:
     """
-    Cast a dense tensor x of shape [B, nnz_S1] (e.g. nnz_S1 = 4358)
-    into a dense tensor of shape [B, nnz_S2] (e.g. nnz_S2 = 57376),
+    Cast a dense tensor x of shape [nnz_S1, B] (e.g. nnz_S1 = 4358)
+    into a dense tensor of shape [nnz_S2, B] (e.g. nnz_S2 = 57376),
     using S1 and S2 as linking sparse tensors.
 
     The linking is done via the following logic:
@@ -27,66 +237,68 @@ def cast_dense_by_sparse_link(
 
     For each nonzero in S2, we use its first index as a key. Then we build a mapping
     from each key (0 to 5044) to the first occurrence index in S1 that has that key.
-    Finally, for each nonzero in S2, we “gather” the corresponding value from x along
-    its second dimension.
+    Finally, for each nonzero in S2, we “gather” the corresponding row from x.
 
     Args:
-        x (torch.Tensor): Dense tensor of shape [B, nnz_S1], where B is batch size.
+        x (torch.Tensor): Dense tensor of shape [nnz_S1, B], where B is the feature size.
         S1 (torch.sparse_coo_tensor): Sparse tensor of shape (483, 5045) with nnz_S1 entries.
         S2 (torch.sparse_coo_tensor): Sparse tensor of shape (5045, 5045) with nnz_S2 entries.
+        mapping (Tuple[torch.Tensor, Optional[torch.Tensor]], optional): Precomputed output of
+            `sparse_link_mapping(S1, S2)`. Computed on the fly if not given.
 
     Returns:
-        torch.Tensor: A dense tensor of shape [B, nnz_S2], where for each nonzero in S2,
+        torch.Tensor: A dense tensor of shape [nnz_S2, B], where for each nonzero in S2,
                       we have assigned the value from x corresponding to the matching key.
                       (If a key is not found in S1, a 0 is placed.)
     """
-    # --- Extract linking keys ---
-    # For S1, we use its second row of indices as keys (values in 0 .. S1.size(1)-1).
-    S1 = S1.coalesce()
-    S1_idx = S1.indices()            # shape: [2, nnz_S1]
-    keys_S1 = S1_idx[1]              # shape: [nnz_S1]
-
-    # For S2, we use its first row of indices as keys.
-    S2 = S2.coalesce()
-    S2_idx = S2.indices()            # shape: [2, nnz_S2]
-    keys_S2 = S2_idx[0]              # shape: [nnz_S2]
-
-    # --- Build mapping from keys to first occurrence index in S1 ---
-    # Create a tensor of positions corresponding to each nonzero in S1.
-    positions = torch.arange(keys_S1.size(0), device=x.device)  # shape: [nnz_S1]
-    # Use scatter_min to compute, for each key (0 .. S1.size(1)-1), the minimum index (first occurrence).
-    # The output will be of shape [S1.size(1)] (i.e. 5045 elements).
-    mapping_out, argmin = scatter_min(positions, keys_S1, dim=0, dim_size=S1.size(1))
-    # For keys that did not occur in S1, scatter_min sets argmin to -1.
-    # We explicitly mark these positions in mapping_out as -1.
-    mapping_out[argmin == -1] = -1  # mapping: tensor of shape [S1.size(1)]
+    if mapping is None:
+        mapping = sparse_link_mapping(S1, S2)
 
     # --- Use the mapping to gather values from x ---
-    # For each nonzero in S2 (each key in keys_S2), look up the corresponding S1 index.
-    mapped_idx = mapping_out[keys_S2]  # shape: [nnz_S2]
-
-    # Create the output dense tensor of shape [B, nnz_S2], initialized with zeros.
-    B = x.size(-1)
-    y = torch.zeros(mapped_idx.size(0), B, dtype=x.dtype, device=x.device)
+    # Gather rows of x (shape [nnz_S1, B]) using the mapped indices. Unmatched keys
+    # read row 0 and are zeroed by the mask.
+    return scaled_gather(x, *sparse_link_cast_index(mapping, x.dtype))  # shape: [nnz_S2, B]
 
-    # Determine positions where a valid mapping exists (mapped index is not -1).
-    valid = mapped_idx != -1  # Boolean tensor of shape [nnz_S2]
-    if valid.any():
-        # Gather values from x along dimension 1 using the mapped indices.
-        # x has shape [B, nnz_S1] and we index along dimension 1.
-        y[valid, :] = x[mapped_idx[valid], :]
 
-    return y
+def cast_and_gather(
+        M: torch.sparse_coo_tensor,
+        H: torch.Tensor,
+        S1: torch.sparse_coo_tensor,
+        S2: torch.sparse_coo_tensor,
+        mapping: Optional[Tuple[torch.Tensor, Optional[torch.Tensor]]] = None,
+        out: Optional[torch.Tensor] = None
+) -> torch.Tensor:
+    """
+    Fused equivalent of `cast_dense_by_sparse_link(compute_sparse_messages(M, H), S1, S2)`
+    that never materialises the [nnz_S1, d_in] message tensor: for each nonzero in S2,
+    the matching nonzero of M is looked up first and only its row of H is gathered.
+
+    :param M: Sparse tensor whose nonzeros are listed in the same order as those of S1,
+              e.g. `S1.T` without coalescing.
+    :param H: Dense tensor of shape [M.size(1), d_in] scaled by the values of M.
+    :param S1: Sparse tensor whose second row of indices holds the linking keys.
+    :param S2: Sparse tensor whose first row of indices holds the linking keys.
+    :param mapping: Precomputed output of `sparse_link_mapping(S1, S2)`. Computed on
+                    the fly if not given.
+    :param out: Optional [nnz_S2, d_in] tensor to write the result into.
+    :return: Dense tensor of shape [nnz_S2, d_in]. Rows whose key is not found in S1
+             are zero.
+    """
+    assert M._nnz() == S1._nnz(), "M must share the nonzeros of S1"
+    if mapping is None:
+        mapping = sparse_link_mapping(S1, S2)
+    index, scale = sparse_link_gather_index(M._indices()[1], M._values(), mapping)
+    return scaled_gather(H, index, scale, out=out)  # shape: [nnz_S2, d_in]
 
 
 def compute_sparse_messages(M: torch.Tensor, H: torch.Tensor) -> torch.Tensor:
     """
     Computes the sparse messages based on the input sparse tensor M and dense
-    tensor H. This function utilizes the `coalesce` method to ensure that
-    the input sparse tensor M has no duplicate indices and is in a canonical
-    format. The function multiplies the values of the sparse tensor M with
-    the corresponding rows in the dense tensor H indicated by the indices
-    of M.
+    tensor H. The input sparse tensor M must already be coalesced, i.e. have
+    no duplicate indices and be in a canonical format. The function multiplies
+    the values of the sparse tensor M with the corresponding rows in the dense
+    tensor H indicated by the indices of M. The column indices and values of M
+    are cached on M on first use, as they are fixed for a given topology.
 
     :param M: Torch sparse tensor where the sparse indices and values
               represent the input data. Must be in a canonical format.
@@ -98,11 +310,19 @@ def compute_sparse_messages(M: torch.Tensor, H: torch.Tensor) -> torch.Tensor:
              the dense tensor H as per the indices of M.
     :rtype: torch.Tensor
     """
-    M = M.coalesce()
-    return M.values().unsqueeze(1) * H[M.indices()[1]]  # shape: [nnz, d_in]
-
-
-def intra_neighborhood_agg(M: torch.Tensor, msgs: torch.Tensor) -> torch.Tensor:
+    assert M.is_coalesced(), "M must be coalesced"
+    cached = getattr(M, "_sparse_messages_cache", None)
+    if cached is None:
+        cached = M._sparse_messages_cache = (M._indices()[1].contiguous(), M._values())
+    col_idx, vals = cached
+    return scaled_gather(H, col_idx, vals)  # shape: [nnz, d_in]
+
+
+def intra_neighborhood_agg(
+        M: torch.Tensor,
+        msgs: torch.Tensor,
+        M_rows: Optional[torch.Tensor] = None
+) -> torch.Tensor:
     """
     Aggregates messages for nodes within the same neighborhood using the given
     coalesced sparse tensor representation.
@@ -118,19 +338,69 @@ def intra_neighborhood_agg(M: torch.Tensor, msgs: torch.Tensor) -> torch.Tensor:
               the graph.
     :param msgs: Tensor of messages to be aggregated, where each message
                  corresponds to an edge in the graph.
+    :param M_rows: Optional output of `row_incidence_csr(M)`. If given, the
+                   aggregation runs as a CSR SpMM instead of a scatter.
     :return: Tensor containing the aggregated messages for each node in the
              graph, with shape `(number of nodes in M, ...)`.
     """
-    M = M.coalesce()
-    return scatter_mean(msgs, M.indices()[0], dim=0, dim_size=M.size(0))
+    assert M.is_coalesced(), "M must be coalesced"
+    if M_rows is not None and msgs.device.type == "cpu":
+        return torch.sparse.mm(M_rows.to(msgs.dtype), msgs, reduce="mean")
+    return scatter_mean(msgs, M._indices()[0], dim=0, dim_size=M.size(0))
+
+
+def semi_structured_supported(weight: torch.Tensor) -> bool:
+    """
+    Whether `torch.sparse.to_sparse_semi_structured` accepts `weight`, i.e. whether
+    the selected sparse backend supports its dtype and shape.
+    """
+    sparse = torch.sparse.SparseSemiStructuredTensor
+    backend = (torch.sparse.SparseSemiStructuredTensorCUTLASS if sparse._FORCE_CUTLASS
+               else torch.sparse.SparseSemiStructuredTensorCUSPARSELT)
+    constraints = backend._DTYPE_SHAPE_CONSTRAINTS.get(weight.dtype)
+    return (constraints is not None and weight.dim() == 2
+            and weight.size(0) % constraints.sparse_min_rows == 0
+            and weight.size(1) % constraints.sparse_min_cols == 0)
+
+
+def dense_compilable(fn):
+    """
+    Decorates a dense `ETNNLayer` method to run through `torch.compile` when the layer
+    has `compile_dense` set. The plain function is compiled once per compile mode and
+    is given the layer as an argument, so nothing compiled is bound to an instance,
+    which keeps `copy.deepcopy` and pickling of the layer working.
+    """
+    compiled = {}
+
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        if not self.compile_dense:
+            return fn(self, *args, **kwargs)
+        if self.compile_mode not in compiled:
+            # shapes are fixed for a given topology, so specialise on them
+            compiled[self.compile_mode] = torch.compile(fn, dynamic=False, mode=self.compile_mode)
+        return compiled[self.compile_mode](self, *args, **kwargs)
+
+    return wrapper
 
 
 class ETNNLayer(MessagePassing):
     def __init__(self, emb_dim: int, edge_attr_dim: int = 2, sse_attr_dim: int = 4, dropout: float = 0.1,
-                 activation: str = "silu", norm: str = "batch", position_update=False, **kwargs) -> None:
+                 activation: str = "silu", norm: str = "batch", position_update=False, compile_dense=False,
+                 compile_mode="reduce-overhead", bf16_autocast=False, parallel_branches=False,
+                 **kwargs) -> None:
         super(ETNNLayer, self).__init__()
 
         self.position_update = position_update
+        # compile the dense parts of the layer (MLPs, concatenations, distance math) with
+        # `torch.compile`; the sparse gathers/scatters around them always run eagerly
+        self.compile_dense = compile_dense
+        self.compile_mode = compile_mode
+        # run messages, aggregations and the feature update under bfloat16 autocast;
+        # coordinates are always updated in float32
+        self.bf16_autocast = bf16_autocast
+        # on CUDA, run `phi_edge` on a side stream so that it overlaps with `phi_sse`
+        self.parallel_branches = parallel_branches
         if "layer_cfg" in kwargs:
             layer_cfg = kwargs.pop("layer_cfg")
             for k, v in layer_cfg.items():
@@ -182,94 +452,236 @@ class ETNNLayer(MessagePassing):
         self.agg_intra = IntraNeighborhoodAggregator(aggr_func="sum")
         self.agg_inter = InterNeighborhoodAggregator(aggr_func="sum")
 
-
-    def forward(self, X, H0, H1, H2, N0_0_via_1, N0_0_via_2, N2_0, N1_0):
-        # step 1 - message passing
-        msg_sse, msg_edge = self.message(X, H0, H1, H2, N0_0_via_1, N0_0_via_2, N2_0, N1_0)
-
-        # step 2 - intra-neighborhood aggregation
-        if self.position_update:
-            msg_pos_via_1 = self.weighted_distance_difference(X, N0_0_via_1, N1_0, self.phi_x(msg_edge))
-            msg_pos_via_2 = self.weighted_distance_difference(X, N0_0_via_2, N2_0, self.phi_x(msg_sse))
-
-        msg_sse = self.agg_intra(N0_0_via_2, msg_sse)
-        msg_edge = self.agg_intra(N0_0_via_1, msg_edge)
-        # step 3 - inter-neighborhood aggregation
-        h_update = self.agg_inter([msg_sse, msg_edge])
+    def forward(self, X, H0, H1, H2, N0_0_via_1, N0_0_via_2, N2_0, N1_0, topology_key=None):
+        # step 0 - coalesce once (a no-op for already coalesced inputs), so that the
+        # helpers below can read `_indices()`/`_values()` directly
+        N0_0_via_1 = N0_0_via_1.coalesce()
+        N0_0_via_2 = N0_0_via_2.coalesce()
+        N2_0 = N2_0.coalesce()
+        N1_0 = N1_0.coalesce()
+        # derived topology tensors, shared by all layers seeing the same `topology_key`
+        topology = prepare_topology(N0_0_via_1, N0_0_via_2, N2_0, N1_0, topology_key)
+
+        autocast = torch.autocast(X.device.type, dtype=torch.bfloat16) if self.bf16_autocast else nullcontext()
+        with autocast:
+            # step 1 - message passing
+            msg_sse, msg_edge = self.message(X, H0, H1, H2, N0_0_via_1, N0_0_via_2, N2_0, N1_0, topology)
+
+            # step 2 - intra-neighborhood aggregation
+            if self.position_update:
+                msg_pos_via_1 = self.weighted_distance_difference(X, N0_0_via_1, N1_0, self.phi_x(msg_edge), topology["cast_1"],
+                                                                  topology["rows_1"].crow_indices())
+                msg_pos_via_2 = self.weighted_distance_difference(X, N0_0_via_2, N2_0, self.phi_x(msg_sse), topology["cast_2"],
+                                                                  topology["rows_2"].crow_indices())
+
+            msg_sse = self.agg_intra(N0_0_via_2, msg_sse, topology["rows_2"])
+            msg_edge = self.agg_intra(N0_0_via_1, msg_edge, topology["rows_1"])
+            # step 3 - inter-neighborhood aggregation
+            h_update = self.agg_inter([msg_sse, msg_edge])
+
+            if self.position_update:
+                x_update = self.agg_inter([msg_pos_via_1, msg_pos_via_2])
+            else:
+                x_update = 0
+
+            # step 4 - update
+            H0 = self.dense_update(H0, h_update)
 
         if self.position_update:
-            x_update = self.agg_inter([msg_pos_via_1, msg_pos_via_2])
-        else:
-            x_update = 0
-
-        # step 4 - update
-        H0_update = self.phi_update(torch.cat([H0, h_update], dim=-1))
-        H0 = H0 + H0_update
+            x_update = x_update.to(X.dtype)
         X = X + x_update
         return H0, X
 
-    def message(self, X, H0, H1, H2, N0_0_via_1, N0_0_via_2, N2_0, N1_0):
-
-        H0_i = H0[N0_0_via_2.indices()[0]]
-        H0_j = H0[N0_0_via_2.indices()[1]]
-        X_i = X[N0_0_via_2.indices()[0]]
-        X_j = X[N0_0_via_2.indices()[1]]
-        dist_norm = torch.norm(X_i - X_j, dim=-1).view(-1, 1)
-        msg_sse = self.phi_sse(torch.cat([
-            H0_i,
-            H0_j,
-            dist_norm,
-            cast_dense_by_sparse_link(compute_sparse_messages(N2_0.T, H2), N2_0, N0_0_via_2)
-        ], dim=-1))
-
-        H0_i = H0[N0_0_via_1.indices()[0]]
-        H0_j = H0[N0_0_via_1.indices()[1]]
-        X_i = X[N0_0_via_1.indices()[0]]
-        X_j = X[N0_0_via_1.indices()[1]]
-        dist_norm = torch.norm(X_i - X_j, dim=-1).view(-1, 1)
-        msg_edge = self.phi_edge(torch.cat([
-            H0_i,
-            H0_j,
-            dist_norm,
-            cast_dense_by_sparse_link(compute_sparse_messages(N1_0.T, H1), N1_0, N0_0_via_1)
-        ], dim=-1))
+    @torch.no_grad()
+    def sparsify(self, semi_structured: bool = True):
+        """
+        Prunes the `Linear` weights of the `phi_*` MLPs to the 2:4 pattern (the two
+        largest-magnitude weights of every group of four inputs are kept). Meant to be
+        called on a trained layer before inference; training itself stays dense.
+
+        The first `Linear` of `phi_sse` and `phi_edge` only has its `H0_i`/`H0_j` block
+        pruned; the distance and attribute columns after it stay dense. Likewise, the
+        last `in_features % 4` columns of any other `Linear` stay dense.
+
+        :param semi_structured: Also convert the pruned weights to
+            `SparseSemiStructuredTensor`s so that matmuls use the sparse tensor
+            cores. Only applied to fully pruned CUDA weights whose dtype and shape
+            the sparse kernels support; otherwise the weights are just masked.
+        """
+        mlps = [self.phi_sse, self.phi_edge, self.phi_update]
+        if self.position_update:
+            mlps.append(self.phi_x)
+        for mlp in mlps:
+            for i, module in enumerate(mlp):
+                if not isinstance(module, Linear):
+                    continue
+                if i == 0 and (mlp is self.phi_sse or mlp is self.phi_edge):
+                    # the inputs are [H0_i, H0_j, dist_norm, attr], with H0_* of size out_features
+                    head = 2 * module.out_features
+                else:
+                    head = module.in_features
+                head -= head % 4
+                if head == 0:
+                    continue
+                weight = module.weight.clone()
+                groups = weight[:, :head].reshape(weight.size(0), -1, 4)
+                keep = groups.abs().topk(2, dim=-1).indices
+                mask = torch.zeros_like(groups, dtype=torch.bool).scatter_(-1, keep, True)
+                weight[:, :head] = (groups * mask).view(weight.size(0), head)
+                if (semi_structured and head == weight.size(1) and weight.is_cuda
+                        and semi_structured_supported(weight)):
+                    weight = torch.sparse.to_sparse_semi_structured(weight)
+                module.weight = torch.nn.Parameter(weight, requires_grad=False)
+
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        """
+        Simplifies the `phi_*` MLPs for inference: `Dropout`s are dropped when they are
+        a no-op (`p == 0` or the layer is in eval mode), and in eval mode every
+        `BatchNorm1d` that directly follows a `Linear` is folded into that `Linear`
+        using its running statistics. `LayerNorm`s depend on the input and are kept.
+        Like `sparsify`, meant to be called on a trained layer before inference (and
+        before `sparsify`, whose 2:4 pattern the folding preserves).
+        """
+        names = ["phi_sse", "phi_edge", "phi_update"]
+        if self.position_update:
+            names.append("phi_x")
+        for name in names:
+            modules = []
+            for module in getattr(self, name):
+                if isinstance(module, Dropout) and (module.p == 0 or not self.training):
+                    continue
+                if (isinstance(module, torch.nn.BatchNorm1d) and not self.training
+                        and module.running_mean is not None and modules and isinstance(modules[-1], Linear)):
+                    linear = modules[-1]
+                    scale = torch.rsqrt(module.running_var + module.eps)
+                    shift = -module.running_mean * scale
+                    if module.affine:
+                        scale = scale * module.weight
+                        shift = shift * module.weight + module.bias
+                    if linear.bias is None:
+                        linear.bias = torch.nn.Parameter(torch.zeros_like(shift))
+                    linear.weight.mul_(scale.unsqueeze(1))
+                    linear.bias.mul_(scale).add_(shift)
+                    continue
+                modules.append(module)
+            setattr(self, name, Sequential(*modules))
+
+    @dense_compilable
+    def dense_update(self, H0, h_update):
+        return H0 + self.phi_update(torch.cat([H0, h_update], dim=-1))
+
+    def message(self, X, H0, H1, H2, N0_0_via_1, N0_0_via_2, N2_0, N1_0, topology):
+        # gather both neighborhoods at once: rows [:nnz_2] belong to N0_0_via_2, the rest to N0_0_via_1
+        src, dst = topology["src"], topology["dst"]
+        # without autograd, the gathers write into buffers shared by all layers of the stack
+        nnz, nnz_2, d = src.size(0), N0_0_via_2._nnz(), H0.size(1)
+        X_i = torch.index_select(X, 0, src, out=workspace_buffer(topology, "X_i", (nnz, X.size(1)), X))
+        X_j = torch.index_select(X, 0, dst, out=workspace_buffer(topology, "X_j", (nnz, X.size(1)), X))
+        cat_sse = workspace_buffer(topology, "cat_sse", (nnz_2, 2 * d + 1 + H2.size(1)), H0)
+        cat_edge = workspace_buffer(topology, "cat_edge", (nnz - nnz_2, 2 * d + 1 + H1.size(1)), H0)
+        if cat_sse is None:
+            return self.dense_message(
+                X_i, X_j, nnz_2,
+                H0.index_select(0, src),
+                H0.index_select(0, dst),
+                # i.e. cast_and_gather(N*_0.T, H*, N*_0, N0_0_via_*)
+                scaled_gather(H2, *topology["gather_2"]),
+                scaled_gather(H1, *topology["gather_1"]),
+            )
+
+        # fill the MLP inputs column by column, leaving column 2 * d for the distance
+        for cat, rows, H, gather in (
+            (cat_sse, slice(None, nnz_2), H2, topology["gather_2"]),
+            (cat_edge, slice(nnz_2, None), H1, topology["gather_1"]),
+        ):
+            torch.index_select(H0, 0, src[rows], out=cat.narrow(1, 0, d))
+            torch.index_select(H0, 0, dst[rows], out=cat.narrow(1, d, d))
+            scaled_gather(H, *gather, out=cat.narrow(1, 2 * d + 1, H.size(1)))
+        return self.dense_message(X_i, X_j, nnz_2, cat_sse=cat_sse, cat_edge=cat_edge, dist_col=2 * d)
+
+    @dense_compilable
+    def dense_message(self, X_i, X_j, nnz_2: int, H0_i=None, H0_j=None, attr_sse=None, attr_edge=None,
+                      cat_sse=None, cat_edge=None, dist_col: int = 0):
+        diff = X_i - X_j
+        # clamped so that the gradient of sqrt stays finite for coincident nodes
+        dist_norm = (diff * diff).sum(dim=-1, keepdim=True).clamp(min=1e-12).sqrt()
+
+        if cat_sse is not None:
+            # `message` already gathered the remaining columns into the buffers
+            cat_sse.narrow(1, dist_col, 1).copy_(dist_norm[:nnz_2])
+            cat_edge.narrow(1, dist_col, 1).copy_(dist_norm[nnz_2:])
+            return self.branch_messages(cat_sse, cat_edge)
+
+        # the MLPs differ in attribute size and normalisation statistics, so split before them
+        cat_sse = torch.cat([
+            H0_i[:nnz_2],
+            H0_j[:nnz_2],
+            dist_norm[:nnz_2],
+            attr_sse
+        ], dim=-1)
+        cat_edge = torch.cat([
+            H0_i[nnz_2:],
+            H0_j[nnz_2:],
+            dist_norm[nnz_2:],
+            attr_edge
+        ], dim=-1)
+        return self.branch_messages(cat_sse, cat_edge)
+
+    def branch_messages(self, cat_sse, cat_edge):
+        # streams are only used eagerly; under `compile_dense` the branches are scheduled by the compiler
+        if not self.parallel_branches or self.compile_dense or not cat_sse.is_cuda:
+            return self.phi_sse(cat_sse), self.phi_edge(cat_edge)
+
+        device = cat_sse.device
+        if device not in _SIDE_STREAMS:
+            _SIDE_STREAMS[device] = torch.cuda.Stream(device)
+        side = _SIDE_STREAMS[device]
+        current = torch.cuda.current_stream(device)
+
+        # the inputs were produced on the current stream
+        side.wait_stream(current)
+        with torch.cuda.stream(side):
+            msg_edge = self.phi_edge(cat_edge)
+        msg_sse = self.phi_sse(cat_sse)
+        current.wait_stream(side)
+        # keep the caching allocator from recycling tensors that cross streams too early
+        cat_edge.record_stream(side)
+        msg_edge.record_stream(current)
         return msg_sse, msg_edge
 
-    def weighted_distance_difference(self, X, A, B, weights):
-        # Adjust weights according to the sparse/dense linkage.
-        weights = cast_dense_by_sparse_link(weights, B, A)
+    def weighted_distance_difference(self, X, A, B, weights, cast=None, rowptr=None):
+        # Adjust weights according to the sparse/dense linkage (`cast` is the cached
+        # `sparse_link_cast_index` of B -> A, if available).
+        if cast is not None:
+            weights = scaled_gather(weights, *cast)
+        else:
+            weights = cast_dense_by_sparse_link(weights, B, A)
 
-        # 1. Get the edge indices.
-        edge_indices = A._indices()  # Shape: [2, num_edges]
-        source_indices = edge_indices[0]  # 1D tensor of source node indices
-        target_indices = edge_indices[1]  # 1D tensor of target node indices
+        # 1. Get the edge indices (source and target node indices, each of shape [num_edges]).
+        source_indices, target_indices = A._indices()
 
         # 2. Gather the coordinates.
-        source_coords = X[source_indices]  # Shape: [num_edges, 3]
-        target_coords = X[target_indices]  # Shape: [num_edges, 3]
+        source_coords = X.index_select(0, source_indices)  # Shape: [num_edges, 3]
+        target_coords = X.index_select(0, target_indices)  # Shape: [num_edges, 3]
 
         # 3. Compute differences and normalize each.
-        diffs = source_coords - target_coords  # Shape: [num_edges, 3]
-        norms = diffs.norm(dim=1, keepdim=True)  # Shape: [num_edges, 1]
-        epsilon = 1
-        normalized_diffs = weights * diffs / (norms + epsilon)  # Shape: [num_edges, 3]
+        normalized_diffs = self.dense_position(source_coords, target_coords, weights)  # Shape: [num_edges, 3]
 
         # 4. Aggregate the normalized differences by computing the mean for each source node.
-        n = X.size(0)
-
-        # Sum the normalized differences for each source node.
-        result_sum = torch.zeros(n, 3, device=X.device)
-        result_sum = result_sum.index_add(0, source_indices, normalized_diffs)
-
-        # Count the number of contributions (edges) per source node.
-        counts = torch.zeros(n, device=X.device)
-        ones = torch.ones(source_indices.size(0), device=X.device)
-        counts = counts.index_add(0, source_indices, ones)
-
-        # Compute the mean by dividing the sum by the count (avoid division by zero).
-        result_mean = result_sum / counts.clamp(min=1).unsqueeze(1)
-
-        return result_mean
+        if rowptr is not None:
+            # A is coalesced, so the edges of each source node are contiguous and the
+            # mean is a segment reduction over `rowptr` (the CSR row pointer of A).
+            return segment_csr(normalized_diffs, rowptr, reduce="mean")
+        return scatter_mean(normalized_diffs, source_indices, dim=0, dim_size=X.size(0))
+
+    @dense_compilable
+    def dense_position(self, source_coords, target_coords, weights):
+        diffs = source_coords - target_coords  # Shape: [num_edges, 3]
+        norms = (diffs * diffs).sum(dim=1, keepdim=True).clamp(min=1e-12).sqrt()  # Shape: [num_edges, 1]
+        epsilon = 1
+        # scale by a per-edge factor so that only one [num_edges, 3] product is formed
+        return diffs * (weights / (norms + epsilon))  # Shape: [num_edges, 3]
 
 #%%
 if __name__ == "__main__":
@@ -298,6 +710,8 @@ if __name__ == "__main__":
     emb = torch.randn(57, 512)
     H0 = H0 @ emb
     layer = ETNNLayer(emb_dim=512, edge_attr_dim=2, sse_attr_dim=4, dropout=0, activation="silu", norm="batch")
+    # warm up (topology cache, and compilation if `compile_dense=True`) before timing
+    layer(X, H0, H1, H2, N0_0_via_1, N0_0_via_2, N2_0, N1_0)
     import time
     tik = time.time()
     H, pos = layer(X, H0, H1, H2, N0_0_via_1, N0_0_via_2, N2_0, N1_0)
@@ -0,0 +1,81 @@
+from typing import Optional
+
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+# `torch.library.custom_op` (used for autograd support) needs torch >= 2.4
+TRITON_AVAILABLE = triton is not None and hasattr(torch.library, "custom_op")
+
+
+if TRITON_AVAILABLE:
+    @triton.jit
+    def _scaled_gather_kernel(out_ptr, h_ptr, index_ptr, scale_ptr, d, out_stride, BLOCK_D: tl.constexpr):
+        # one program per output row: out[row] = H[index[row]] * scale[row]
+        row = tl.program_id(0).to(tl.int64)
+        src = tl.load(index_ptr + row).to(tl.int64)
+        scale = tl.load(scale_ptr + row)
+        for start in range(0, d, BLOCK_D):
+            offs = start + tl.arange(0, BLOCK_D)
+            mask = offs < d
+            h = tl.load(h_ptr + src * d + offs, mask=mask)
+            tl.store(out_ptr + row * out_stride + offs, (h * scale).to(out_ptr.dtype.element_ty), mask=mask)
+
+    def _launch(out: torch.Tensor, H: torch.Tensor, index: torch.Tensor, scale: torch.Tensor) -> torch.Tensor:
+        if index.numel() > 0 and H.size(1) > 0:
+            block_d = min(triton.next_power_of_2(H.size(1)), 1024)
+            _scaled_gather_kernel[(index.numel(),)](out, H, index, scale, H.size(1), out.stride(0),
+                                                    BLOCK_D=block_d)
+        return out
+
+    @torch.library.custom_op("topotein::scaled_gather", mutates_args=())
+    def _scaled_gather(H: torch.Tensor, index: torch.Tensor, scale: torch.Tensor) -> torch.Tensor:
+        H = H.contiguous()
+        out = torch.empty(index.size(0), H.size(1), dtype=H.dtype, device=H.device)
+        return _launch(out, H, index.contiguous(), scale.contiguous())
+
+    @_scaled_gather.register_fake
+    def _(H, index, scale):
+        return H.new_empty(index.size(0), H.size(1))
+
+    def _setup_context(ctx, inputs, output):
+        H, index, scale = inputs
+        ctx.save_for_backward(index, scale)
+        ctx.num_rows = H.size(0)
+
+    def _backward(ctx, grad):
+        index, scale = ctx.saved_tensors
+        grad_H = grad.new_zeros(ctx.num_rows, grad.size(1))
+        grad_H.index_add_(0, index, grad * scale.unsqueeze(1).to(grad.dtype))
+        return grad_H, None, None
+
+    _scaled_gather.register_autograd(_backward, setup_context=_setup_context)
+
+
+def triton_scaled_gather(
+        H: torch.Tensor,
+        index: torch.Tensor,
+        scale: torch.Tensor,
+        out: Optional[torch.Tensor] = None
+) -> torch.Tensor:
+    """
+    Computes `H[index] * scale[:, None]` in a single Triton kernel, without the
+    intermediate gathered tensor. Requires `TRITON_AVAILABLE`. Gradients flow to
+    H only; `index` and `scale` are treated as constants.
+
+    :param H: Dense tensor of shape [n, d].
+    :param index: Row index of shape [m].
+    :param scale: Per-row scale of shape [m].
+    :param out: Optional [m, d] tensor to write the result into, e.g. a column
+                slice of a wider buffer (its rows must be contiguous). Only
+                supported while autograd is not recording.
+    :return: Dense tensor of shape [m, d].
+    """
+    if out is None:
+        return torch.ops.topotein.scaled_gather(H, index, scale)
+    assert not torch.is_grad_enabled() and out.stride(-1) == 1
+    return _launch(out, H.contiguous(), index.contiguous(), scale.contiguous())